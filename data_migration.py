@@ -1,6 +1,5 @@
 import time
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg
 
 # Source database connection parameters
 SOURCE_DB_PARAMS = {
@@ -22,71 +21,149 @@ DEST_DB_PARAMS = {
 
 BATCH_SIZE = 100000 
 
-def connect_to_db(params):
-    return psycopg2.connect(**params)
+# Session settings for the destination connection. The migration is an idempotent upsert,
+# so commits need not wait for the WAL fsync; after a server crash, simply re-run it.
+DEST_SESSION_OPTIONS = "-c synchronous_commit=off"
 
-def fetch_source_data(conn, offset, limit):
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("""
-            SELECT image_name, publisher, created_at, updated_at, short_description, pull_count
+MIGRATED_COLUMNS = "image_name, publisher, created_at, updated_at, short_description, pull_count"
+
+def connect_to_db(params, **kwargs):
+    return psycopg.connect(**params, **kwargs)
+
+def fetch_source_data(conn, batch_size, select_list):
+    # A named cursor keeps the result set on the server and streams it in FETCH
+    # batches, so the query runs once instead of re-scanning for every OFFSET.
+    with conn.cursor(name='migrate_images') as cur:
+        cur.itersize = 10000
+        cur.arraysize = 10000
+        cur.execute(f"""
+            SELECT {select_list}
             FROM dockerstudy_image
             WHERE image_name IS NOT NULL
-            ORDER BY image_name
-            OFFSET %s LIMIT %s
-        """, (offset, limit))
-        return cur.fetchall()
+        """)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+def has_unique_index(cur, table, columns):
+    # Same rule as the scanner's has_unique_index: a valid, non-partial unique index whose key
+    # columns are exactly the given ones. INCLUDE columns, stored after the first indnkeyatts
+    # entries of indkey, are not part of the key and so are left out of the comparison.
+    cur.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_index i
+            WHERE i.indrelid = %s::regclass
+              AND i.indisunique
+              AND i.indisvalid
+              AND i.indpred IS NULL
+              AND ARRAY(
+                  SELECT a.attname::text FROM pg_attribute a
+                  WHERE a.attrelid = i.indrelid
+                    AND a.attnum = ANY((i.indkey::int2[])[0:i.indnkeyatts - 1])
+                  ORDER BY a.attname
+              ) = %s::text[]
+        )
+    """, (table, sorted(columns)))
+    return cur.fetchone()[0]
+
+def drop_invalid_index(cur, index_name):
+    # Same check as the scanner's drop_invalid_index: only an index left INVALID by a failed
+    # build is dropped, never a valid index that merely shares the name.
+    cur.execute("""
+        SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)
+    """, (index_name,))
+    row = cur.fetchone()
+    if row and row[0]:
+        print(f"Dropping invalid index {index_name} left by an earlier failed build...")
+        cur.execute(f"DROP INDEX {index_name}")
+
+def ensure_unique_image_name(conn):
+    # The merge's ON CONFLICT (image_name) needs a unique index on images (image_name).
+    # Nothing else writes to images during the migration, so a plain CREATE INDEX is used:
+    # if it fails, e.g. on duplicate names, it rolls back instead of leaving an invalid index.
+    with conn.cursor() as cur:
+        if not has_unique_index(cur, 'images', ('image_name',)):
+            drop_invalid_index(cur, 'images_image_name_uidx')
+            print("Creating unique index images_image_name_uidx on images (image_name)...")
+            cur.execute("CREATE UNIQUE INDEX images_image_name_uidx ON images (image_name)")
+    conn.commit()
+
+def create_staging_table(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE UNLOGGED TABLE IF NOT EXISTS images_stage AS
+            SELECT {MIGRATED_COLUMNS} FROM images WITH NO DATA
+        """)
+        cur.execute("TRUNCATE images_stage")
+        # Binary COPY needs the exact column types of the target table
+        cur.execute(f"SELECT {MIGRATED_COLUMNS} FROM images_stage LIMIT 0")
+        column_types = [column.type_code for column in cur.description]
+        # Binary COPY also sends values as-is, so the source query casts each column
+        # to its staging type instead of leaving the conversion to the server. Only the
+        # base type is used: an explicit cast to varchar(n) silently truncates, whereas
+        # COPY still rejects over-length values against the staging column's limit.
+        cur.execute("""
+            SELECT attname, format_type(atttypid, NULL)
+            FROM pg_attribute
+            WHERE attrelid = 'images_stage'::regclass AND attnum > 0 AND NOT attisdropped
+            ORDER BY attnum
+        """)
+        select_list = ", ".join(f"{name}::{column_type} AS {name}" for name, column_type in cur.fetchall())
+    conn.commit()
+    return column_types, select_list
 
-def insert_destination_data(conn, data):
+def insert_destination_data(conn, data, column_types):
     with conn.cursor() as cur:
-        cur.executemany("""
-            INSERT INTO images (image_name, publisher, created_at, updated_at, short_description, pull_count)
-            VALUES (%(image_name)s, %(publisher)s, %(created_at)s, %(updated_at)s, %(short_description)s, %(pull_count)s)
-            ON CONFLICT DO NOTHING;
-            
-            UPDATE images SET
-                publisher = %(publisher)s,
-                created_at = %(created_at)s,
-                updated_at = %(updated_at)s,
-                short_description = %(short_description)s,
-                pull_count = %(pull_count)s
-            WHERE image_name = %(image_name)s
-        """, data)
+        with cur.copy(f"COPY images_stage ({MIGRATED_COLUMNS}) FROM STDIN WITH (FORMAT BINARY)") as copy:
+            copy.set_types(column_types)
+            for row in data:
+                copy.write_row(row)
     conn.commit()
 
-def get_total_count(conn):
+def merge_staging_table(conn):
     with conn.cursor() as cur:
-        cur.execute("SELECT COUNT(*) FROM dockerstudy_image WHERE image_name IS NOT NULL")
-        return cur.fetchone()[0]
+        # DISTINCT ON keeps one row per image_name: ON CONFLICT DO UPDATE cannot touch the same row twice.
+        cur.execute(f"""
+            INSERT INTO images ({MIGRATED_COLUMNS})
+            SELECT DISTINCT ON (image_name) {MIGRATED_COLUMNS}
+            FROM images_stage
+            ON CONFLICT (image_name) DO UPDATE SET
+                publisher = EXCLUDED.publisher,
+                created_at = EXCLUDED.created_at,
+                updated_at = EXCLUDED.updated_at,
+                short_description = EXCLUDED.short_description,
+                pull_count = EXCLUDED.pull_count
+        """)
+        cur.execute("DROP TABLE images_stage")
+    conn.commit()
 
 def main():
     source_conn = connect_to_db(SOURCE_DB_PARAMS)
-    dest_conn = connect_to_db(DEST_DB_PARAMS)
+    dest_conn = connect_to_db(DEST_DB_PARAMS, options=DEST_SESSION_OPTIONS)
 
     try:
-        total_records = get_total_count(source_conn)
-        print(f"Total records to process: {total_records}")
+        ensure_unique_image_name(dest_conn)
+        column_types, select_list = create_staging_table(dest_conn)
 
-        offset = 0
         processed_records = 0
         start_time = time.time()
 
-        while offset < total_records:
-            print(f"Fetching batch starting at offset {offset}...")
-            source_data = fetch_source_data(source_conn, offset, BATCH_SIZE)
-            
-            print(f"Inserting batch into destination database...")
-            insert_destination_data(dest_conn, source_data)
-            
+        for source_data in fetch_source_data(source_conn, BATCH_SIZE, select_list):
+            print(f"Copying batch of {len(source_data)} records into staging table...")
+            insert_destination_data(dest_conn, source_data, column_types)
+
             processed_records += len(source_data)
-            offset += BATCH_SIZE
 
             elapsed_time = time.time() - start_time
             records_per_second = processed_records / elapsed_time
-            estimated_total_time = total_records / records_per_second
-            estimated_remaining_time = estimated_total_time - elapsed_time
 
-            print(f"Processed {processed_records}/{total_records} records. "
-                  f"Estimated time remaining: {estimated_remaining_time/60:.2f} minutes")
+            print(f"Processed {processed_records} records "
+                  f"({records_per_second:.0f} records/second)")
+
+        print("Merging staging table into images...")
+        merge_staging_table(dest_conn)
 
         print("Data migration completed successfully.")
 
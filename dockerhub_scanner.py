@@ -1,8 +1,19 @@
+import asyncio
+import collections
+import contextlib
 import datetime
+import multiprocessing
+import os
+import queue
+import re
+import socket
 import subprocess
-import json
+import threading
+import time
+import docker
+import orjson
 import psycopg2
-from psycopg2.extras import execute_values
+import requests
 import concurrent.futures
 import logging
 
@@ -18,34 +29,270 @@ DB_PARAMS = {
     'port': 5432
 }
 
-# Number of parallel processes, can be changed depending on the system capabilities
-NUM_PROCESSES = 6
+# Unique indexes required by the ON CONFLICT clauses, as (index name, table, columns)
+UNIQUE_INDEXES = [
+    ('images_image_name_uidx', 'images', ('image_name',)),
+    ('vulnerabilities_vulnerability_name_uidx', 'vulnerabilities', ('vulnerability_name',)),
+    ('packages_name_version_uidx', 'packages', ('name', 'version')),
+    ('image_vulnerabilities_uidx', 'image_vulnerabilities', ('image_id', 'vulnerability_id', 'package_id'))
+]
 
-def get_unscanned_container():
+# Session settings for the workers' connections. Commits do not wait for the WAL fsync, since
+# every write can be safely redone: a database server crash can only lose the last few commits,
+# leaving those images 'in_progress' exactly as a worker crash would. Restart the scanner with
+# DD_RESET_IN_PROGRESS=1 to return them to 'pending'.
+SESSION_OPTIONS = '-c synchronous_commit=off'
+
+# Number of parallel processes, can be changed with the DD_WORKERS environment variable.
+# Throughput plateaus at around 4 workers because of Docker daemon contention.
+NUM_PROCESSES = int(os.environ.get('DD_WORKERS', min(4, os.cpu_count() or 1)))
+
+# Maximum number of concurrent docker pulls across all worker processes
+MAX_CONCURRENT_PULLS = 4
+
+# Semaphore shared by the worker processes to bound concurrent pulls, set by init_worker
+_PULL_SEMAPHORE = contextlib.nullcontext()
+
+# Event set while grype scans may start, and the number of scans running, shared by the
+# worker processes so main() can update the grype database between scans. Set by init_worker.
+_SCAN_GATE = None
+_ACTIVE_SCANS = None
+
+# Environment for grype scans. The database is updated by main(), at startup and then every
+# GRYPE_DB_UPDATE_INTERVAL seconds, so each scan skips grype's own database and application
+# update checks on startup.
+# Set GRYPE_DB_CACHE_DIR (e.g. to a tmpfs path) to keep the database memory-resident.
+GRYPE_ENV = {
+    **os.environ,
+    'GRYPE_DB_AUTO_UPDATE': 'false',
+    'GRYPE_CHECK_FOR_APP_UPDATE': 'false'
+}
+
+# Seconds between grype database updates. grype refuses to scan with a database built more
+# than 5 days ago (db.max-allowed-built-age), so this must stay well below that.
+GRYPE_DB_UPDATE_INTERVAL = 12 * 60 * 60
+
+# Whether to return images left 'in_progress' to 'pending' at startup, set with DD_RESET_IN_PROGRESS=1.
+# Only enable it while no other scanner instance is working on the same database.
+RESET_IN_PROGRESS = os.environ.get('DD_RESET_IN_PROGRESS') == '1'
+
+# Number of images a worker claims from the database in one round trip
+CLAIM_BATCH_SIZE = 8
+
+# Maximum number of images waiting between two stages of a worker's pipeline, including its database writer
+PIPELINE_QUEUE_SIZE = 2
+
+# Errors raised by docker-py, including connection errors and timeouts talking to the daemon
+DOCKER_ERRORS = (docker.errors.DockerException, requests.exceptions.RequestException)
+
+# Persistent database connections and Docker clients, created lazily for each thread of a worker process
+_LOCAL = threading.local()
+
+# Queue of database writes for the running process_container call, consumed by db_writer
+_DB_WRITES = None
+
+def init_worker(pull_semaphore, scan_gate, active_scans):
+    """
+    Initializes a worker process of the process pool.
+
+    Args:
+        pull_semaphore (multiprocessing.Semaphore): Semaphore bounding concurrent pulls across workers.
+        scan_gate (multiprocessing.Event): Set while grype scans may start.
+        active_scans (multiprocessing.Value): Number of grype scans running across workers.
+
+    Returns:
+        None
+    """
+    global _PULL_SEMAPHORE, _SCAN_GATE, _ACTIVE_SCANS
+    _PULL_SEMAPHORE = pull_semaphore
+    _SCAN_GATE = scan_gate
+    _ACTIVE_SCANS = active_scans
+
+@contextlib.contextmanager
+def scan_slot():
+    """
+    Waits until grype scans are allowed, then counts the enclosed scan as running,
+    so that main() never replaces the grype database while a scan is reading it.
+    Does nothing outside the process pool.
+
+    Yields:
+        None
+    """
+    if _SCAN_GATE is None:
+        yield
+        return
+
+    while True:
+        _SCAN_GATE.wait()
+        # Re-check under the lock main() holds while pausing, so no scan starts after it has counted
+        with _ACTIVE_SCANS.get_lock():
+            if _SCAN_GATE.is_set():
+                _ACTIVE_SCANS.value += 1
+                break
+    try:
+        yield
+    finally:
+        with _ACTIVE_SCANS.get_lock():
+            _ACTIVE_SCANS.value -= 1
+
+def get_connection():
+    """
+    Returns the calling thread's persistent database connection, opening a new one if needed.
+
+    Each pipeline stage runs its blocking calls in a worker thread, so connections are kept
+    per thread to stop one stage from committing or rolling back another stage's transaction.
+
+    psycopg2 marks a connection as closed once its socket has dropped, so a stale
+    connection is transparently replaced on the next call.
+
+    Returns:
+        psycopg2.extensions.connection: The open database connection.
     """
-    Retrieves the name of an unscanned container from the database and marks it as 'in_progress'.
+    conn = getattr(_LOCAL, 'conn', None)
+    if conn is None or conn.closed:
+        conn = psycopg2.connect(**DB_PARAMS, options=SESSION_OPTIONS)
+        prepare_statements(conn)
+        _LOCAL.conn = conn
+    return conn
+
+def prepare_statements(conn):
+    """
+    Prepares the scanner's most frequently run statements on a new connection,
+    so they are parsed and planned once per connection instead of on every call.
+
+    Args:
+        conn (psycopg2.extensions.connection): The newly opened database connection.
 
     Returns:
-        str or None: The name of the unscanned container, or None if no unscanned containers are found.
+        None
     """
-    with psycopg2.connect(**DB_PARAMS) as conn:
+    with conn:
         with conn.cursor() as cur:
             cur.execute("""
-                UPDATE images
-                SET download_status = 'in_progress'
-                WHERE image_name = (
-                    SELECT image_name FROM images 
-                    WHERE is_scanned = FALSE 
-                      AND download_status = 'pending'
-                    ORDER BY COALESCE(pull_count, 0) DESC 
-                    LIMIT 1 FOR UPDATE SKIP LOCKED
+                PREPARE claim_images(int) AS
+                WITH claimed AS (
+                    UPDATE images
+                    SET download_status = 'in_progress'
+                    WHERE image_name IN (
+                        SELECT image_name FROM images 
+                        WHERE is_scanned = FALSE 
+                          AND download_status = 'pending'
+                        ORDER BY pull_count DESC NULLS LAST 
+                        LIMIT $1 FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING image_name, pull_count
                 )
-                RETURNING image_name
+                -- UPDATE ... RETURNING has no defined order, so restore the popularity order
+                SELECT image_name FROM claimed
+                ORDER BY pull_count DESC NULLS LAST
+            """)
+            cur.execute("""
+                PREPARE set_status(text, text) AS
+                UPDATE images 
+                SET download_status = $1, 
+                    is_scanned = TRUE,
+                    last_scanned = NOW()
+                WHERE image_name = $2
             """)
-            result = cur.fetchone()
-            if result:
-                return result[0]
-    return None
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Runs a block in a transaction on the calling thread's persistent connection,
+    committing on success and rolling back on error.
+
+    Unlike 'with conn:', it does not try to roll back a connection that has been lost,
+    which would replace the original error with 'connection already closed'.
+
+    Yields:
+        psycopg2.extensions.connection: The open database connection.
+    """
+    conn = get_connection()
+    try:
+        yield conn
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+def connection_lost():
+    """
+    Checks whether the calling thread's persistent database connection has been lost.
+
+    OperationalError also covers errors such as QueryCanceledError and TransactionRollbackError
+    that leave the connection usable, so only conn.closed tells whether it was actually dropped.
+
+    Returns:
+        bool: True if the thread has a connection and it is closed, False otherwise.
+    """
+    conn = getattr(_LOCAL, 'conn', None)
+    return conn is not None and bool(conn.closed)
+
+def retry_on_disconnect(operation, *args):
+    """
+    Runs a database operation, retrying it once if the connection was lost, e.g. after the
+    server dropped it. The retry reconnects through get_connection.
+
+    The server may have committed the operation before the connection dropped,
+    so it must be safe to run twice.
+
+    Args:
+        operation (callable): The function performing the database work.
+        *args: The arguments to call it with.
+
+    Returns:
+        The operation's return value.
+    """
+    try:
+        return operation(*args)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        if not connection_lost():
+            raise
+        logging.warning(f"Lost the database connection in {operation.__name__}, reconnecting and retrying once: {e}")
+        return operation(*args)
+
+def get_docker_client():
+    """
+    Returns the calling thread's Docker Engine API client, creating it if needed.
+
+    The client keeps its connection to the Docker daemon socket alive across images.
+
+    Returns:
+        docker.DockerClient: The Docker client.
+    """
+    client = getattr(_LOCAL, 'docker_client', None)
+    if client is None:
+        client = _LOCAL.docker_client = docker.from_env()
+    return client
+
+def get_unscanned_containers(limit=CLAIM_BATCH_SIZE):
+    """
+    Retrieves the names of up to `limit` unscanned containers from the database and marks them as 'in_progress'.
+
+    Args:
+        limit (int): The maximum number of containers to claim.
+
+    Returns:
+        list of str: The names of the unscanned containers, empty if no unscanned containers are found.
+    """
+    return retry_on_disconnect(claim_unscanned_containers, limit)
+
+def claim_unscanned_containers(limit):
+    """
+    Claims the most pulled pending images on the calling thread's connection.
+
+    Args:
+        limit (int): The maximum number of containers to claim.
+
+    Returns:
+        list of str: The names of the claimed containers, empty if no unscanned containers are found.
+    """
+    with transaction() as conn:
+        with conn.cursor() as cur:
+            cur.execute("EXECUTE claim_images(%s)", (limit,))
+            return [row[0] for row in cur.fetchall()]
 
 def pull_container(image_name):
     """
@@ -59,15 +306,21 @@ def pull_container(image_name):
     """
     try:
         logging.info(f"Pulling {image_name}...")
-        subprocess.run(['docker', 'pull', image_name], check=True, capture_output=True, text=True)
+        repository, tag = docker.utils.parse_repository_tag(image_name)
+        with _PULL_SEMAPHORE:
+            # The daemon reports failures after the pull has started as 'error' entries in the
+            # progress stream, which images.pull() would ignore; stop at the first one instead
+            for chunk in get_docker_client().api.pull(repository, tag=tag or 'latest', stream=True, decode=True):
+                if 'error' in chunk:
+                    raise docker.errors.DockerException(chunk.get('errorDetail', {}).get('message') or chunk['error'])
         logging.info(f"Successfully pulled {image_name}")
         return True
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error pulling {image_name}: {e.stderr}")
-        if 'manifest unknown' in e.stderr:
-            update_download_status(image_name, 'manifest_unknown')
+    except DOCKER_ERRORS as e:
+        logging.error(f"Error pulling {image_name}: {e}")
+        if 'manifest unknown' in str(e):
+            submit_db_write(update_download_status, image_name, 'manifest_unknown')
         else:
-            update_download_status(image_name, 'download_failed')
+            submit_db_write(update_download_status, image_name, 'download_failed')
         return False
 
 def update_download_status(image_name, status):
@@ -81,16 +334,9 @@ def update_download_status(image_name, status):
     Returns:
         None
     """
-    with psycopg2.connect(**DB_PARAMS) as conn:
+    with transaction() as conn:
         with conn.cursor() as cur:
-            cur.execute("""
-                UPDATE images 
-                SET download_status = %s, 
-                    is_scanned = TRUE,
-                    last_scanned = NOW()
-                WHERE image_name = %s
-            """, (status, image_name))
-        conn.commit()
+            cur.execute("EXECUTE set_status(%s, %s)", (status, image_name))
 
 def scan_container(image_name):
     """
@@ -108,11 +354,13 @@ def scan_container(image_name):
     """
     try:
         logging.info(f"Scanning {image_name} ...")
-        result = subprocess.run(['grype', image_name, '-o', 'json'], capture_output=True, text=True, check=True)
+        # -q keeps grype's progress output out of the captured stderr, leaving only errors
+        with scan_slot():
+            result = subprocess.run(['grype', image_name, '-o', 'json', '-q'], capture_output=True, check=True, env=GRYPE_ENV)
         logging.info(f"Successfully scanned {image_name}")
-        return json.loads(result.stdout)
+        return orjson.loads(result.stdout)
     except subprocess.CalledProcessError as e:
-        logging.error(f"Error scanning {image_name}: {e.stderr}")
+        logging.error(f"Error scanning {image_name}: {e.stderr.decode(errors='replace')}")
         return None
 
 def delete_container(image_name):
@@ -122,17 +370,40 @@ def delete_container(image_name):
     Args:
         image_name (str): The name of the Docker image to delete.
 
-    Raises:
-        subprocess.CalledProcessError: If an error occurs while deleting the container.
-
     Returns:
         None
     """
     try:
-        subprocess.run(['docker', 'rmi', image_name], check=True, capture_output=True, text=True)
+        get_docker_client().images.remove(image_name, force=True)
         logging.info(f"Successfully deleted {image_name}")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error deleting {image_name}: {e.stderr}")
+    except DOCKER_ERRORS as e:
+        logging.error(f"Error deleting {image_name}: {e}")
+
+def mogrify_values(cur, template, rows):
+    """
+    Renders rows into a comma-separated VALUES list.
+
+    Args:
+        cur (psycopg2.extensions.cursor): The cursor used to quote the values.
+        template (str): The placeholder template for a single row, e.g. '(%s, %s)'.
+        rows (iterable): The rows to render.
+
+    Returns:
+        bytes: The rendered rows, ready to follow a VALUES keyword.
+    """
+    return b",".join(cur.mogrify(template, row) for row in rows)
+
+def sort_key(row):
+    """
+    Orders rows that may contain None values, which cannot be compared with strings.
+
+    Args:
+        row (tuple): The row to order.
+
+    Returns:
+        tuple: A key ordering None after every other value in each position.
+    """
+    return tuple((value is None, value or '') for value in row)
 
 def parse_and_upload_scan_result(scan_result, image_name):
     """
@@ -146,27 +417,25 @@ def parse_and_upload_scan_result(scan_result, image_name):
         Exception: If there is an error parsing and uploading the scan result.
     """
     pass
-    with psycopg2.connect(**DB_PARAMS) as conn:
-        try:
+    try:
+        with transaction() as conn:
             with conn.cursor() as cur:
-                # Update images table
-                image_size = scan_result.get('source', {}).get('target', {}).get('imageSize')
-                
-                cur.execute("""
-                    UPDATE images SET
-                        image_size = %s,
-                        is_scanned = TRUE,
-                        last_scanned = NOW(),
-                        download_status = 'success'
-                    WHERE image_name = %s
-                    RETURNING image_id
-                """, (image_size, image_name,))
-                image_id = cur.fetchone()[0]
+                # Every statement below is rendered client-side and sent in a single
+                # execute, so the whole upload costs one round trip. Statements that
+                # need the image_id look it up with a subquery instead of waiting for
+                # the UPDATE's RETURNING value.
+                image_id = cur.mogrify("(SELECT image_id FROM images WHERE image_name = %s)", (image_name,))
+                statements = []
 
-                # Process vulnerabilities
-                vulnerabilities = []
-                packages = []
+                # Process vulnerabilities; the same vulnerability and package appear
+                # in many matches, so they are de-duplicated before being sent. They are
+                # inserted in sorted order so that workers inserting overlapping new rows
+                # take their key locks in the same order and cannot deadlock.
+                vulnerabilities = set()
+                packages = set()
                 image_vulnerabilities = []
+                # Severities are counted per match, not per distinct vulnerability
+                vulnerability_counts = collections.Counter()
                 
                 for match in scan_result.get('matches', []):
                     vuln = match.get('vulnerability', {})
@@ -175,132 +444,478 @@ def parse_and_upload_scan_result(scan_result, image_name):
                     # Vulnerability data
                     vuln_name = vuln.get('id')
                     severity = vuln.get('severity')
-                    vulnerabilities.append((vuln_name, severity))
+                    vulnerabilities.add((vuln_name, severity))
+                    vulnerability_counts[severity] += 1
                     
                     # Package data
                     package_name = artifact.get('name')
                     package_version = artifact.get('version')
-                    packages.append((package_name, package_version))
+                    packages.add((package_name, package_version))
                     
                     # Image vulnerability relation data
                     fix_state = vuln.get('fix', {}).get('state')
-                    image_vulnerabilities.append((image_id, vuln_name, package_name, package_version, fix_state))
-
-                # Insert vulnerabilities
-                execute_values(cur, """
-                    INSERT INTO vulnerabilities (vulnerability_name, severity)
-                    VALUES %s
-                    ON CONFLICT (vulnerability_name) DO NOTHING
-                """, vulnerabilities)
-
-                # Insert packages
-                execute_values(cur, """
-                    INSERT INTO packages (name, version)
-                    VALUES %s
-                    ON CONFLICT (name, version) DO NOTHING
-                """, packages)
-
-                # Insert image_vulnerabilities
-                for iv in image_vulnerabilities:
-                    cur.execute("""
-                        WITH vuln_id AS (
-                            SELECT vulnerability_id FROM vulnerabilities WHERE vulnerability_name = %s
-                        ), pkg_id AS (
-                            SELECT package_id FROM packages WHERE name = %s AND version = %s
-                        )
+                    image_vulnerabilities.append((vuln_name, package_name, package_version, fix_state))
+
+                if image_vulnerabilities:
+                    # Insert vulnerabilities
+                    statements.append(b"""
+                        INSERT INTO vulnerabilities (vulnerability_name, severity)
+                        VALUES """ + mogrify_values(cur, "(%s, %s)", sorted(vulnerabilities, key=sort_key)) + b"""
+                        ON CONFLICT (vulnerability_name) DO NOTHING
+                    """)
+
+                    # Insert packages
+                    statements.append(b"""
+                        INSERT INTO packages (name, version)
+                        VALUES """ + mogrify_values(cur, "(%s, %s)", sorted(packages, key=sort_key)) + b"""
+                        ON CONFLICT (name, version) DO NOTHING
+                    """)
+
+                    # Insert image_vulnerabilities
+                    statements.append(b"""
                         INSERT INTO image_vulnerabilities (image_id, vulnerability_id, package_id, fix_state)
-                        SELECT %s, vuln_id.vulnerability_id, pkg_id.package_id, %s
-                        FROM vuln_id, pkg_id
+                        SELECT """ + image_id + b""", v.vulnerability_id, p.package_id, iv.fix_state
+                        FROM (VALUES """ + mogrify_values(cur, "(%s, %s, %s, %s)", image_vulnerabilities) + b""")
+                            AS iv (vulnerability_name, package_name, package_version, fix_state)
+                        JOIN vulnerabilities v ON v.vulnerability_name = iv.vulnerability_name
+                        JOIN packages p ON p.name = iv.package_name AND p.version = iv.package_version
                         ON CONFLICT (image_id, vulnerability_id, package_id) DO NOTHING
-                    """, (iv[1], iv[2], iv[3], iv[0], iv[4]))
+                    """)
 
-                # Insert scan metadata
-                vulnerability_counts = {}
-                for vuln in vulnerabilities:
-                    vulnerability_counts[vuln[1]] = vulnerability_counts.get(vuln[1], 0) + 1
+                # Insert scan metadata. scan_metadata has no conflict key, so the row is
+                # skipped once the image is marked 'success': the upload is retried after a
+                # lost connection, which may happen after the server applied the commit.
                 vulnerability_counts['total'] = sum(vulnerability_counts.values())
                 
-                cur.execute("""
+                statements.append(cur.mogrify("""
                     INSERT INTO scan_metadata (
                         image_id, timestamp, total_vulnerabilities,
                         critical_count, high_count, medium_count, low_count, 
                         negligible_count, unknown_count
                     )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    SELECT image_id, %s, %s, %s, %s, %s, %s, %s, %s
+                    FROM images
+                    WHERE image_name = %s
+                      AND download_status IS DISTINCT FROM 'success'
                 """, (
-                    image_id,
                     datetime.datetime.now(),
-                    vulnerability_counts.get('total', 0),
-                    vulnerability_counts.get('Critical', 0),
-                    vulnerability_counts.get('High', 0),
-                    vulnerability_counts.get('Medium', 0),
-                    vulnerability_counts.get('Low', 0),
-                    vulnerability_counts.get('Negligible', 0), 
-                    vulnerability_counts.get('Unknown', 0)
-                ))
-
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            logging.error(f"Error parsing and uploading scan result for {image_name}: {e}")
-        else:
-            logging.info(f"Successfully parsed and uploaded scan result for {image_name}")
+                    vulnerability_counts['total'],
+                    vulnerability_counts['Critical'],
+                    vulnerability_counts['High'],
+                    vulnerability_counts['Medium'],
+                    vulnerability_counts['Low'],
+                    vulnerability_counts['Negligible'], 
+                    vulnerability_counts['Unknown'],
+                    image_name
+                )))
+
+                # Update images table last: only the final statement's result is
+                # returned, and an unknown image must abort the whole upload
+                image_size = scan_result.get('source', {}).get('target', {}).get('imageSize')
+                
+                statements.append(cur.mogrify("""
+                    UPDATE images SET
+                        image_size = %s,
+                        is_scanned = TRUE,
+                        last_scanned = NOW(),
+                        download_status = 'success'
+                    WHERE image_name = %s
+                    RETURNING image_id
+                """, (image_size, image_name,)))
+
+                cur.execute(b";".join(statements))
+                if cur.fetchone() is None:
+                    raise LookupError(f"{image_name} is not in the images table")
+
+    except Exception as e:
+        if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)) and connection_lost():
+            # A lost connection is retried by the caller on a fresh connection
+            raise
+        logging.error(f"Error parsing and uploading scan result for {image_name}: {e}")
+    else:
+        logging.info(f"Successfully parsed and uploaded scan result for {image_name}")
             
-def process_container():
+async def pull_stage(pulled):
     """
-    Process a container by performing the following steps:
-    1. Get the name of an unscanned container.
-    2. If no unscanned container is found, return False.
-    3. Pull the container image.
-    4. Scan the container image.
-    5. Delete the container image.
-    6. If the scan result is available:
-        - Parse and upload the scan result.
-    7. If the scan result is not available:
-        - Update the download status of the container to 'scan_failed'.
-        - Log an error message.
-    8. If there are download issues with the container:
-        - Log an info message indicating that processing was skipped.
-    9. Return True to indicate successful processing.
+    Claims and pulls unscanned containers until none are left, passing each pulled image on.
+
+    Args:
+        pulled (asyncio.Queue): Receives the names of pulled images, then None once no unscanned containers remain.
+
     Returns:
-        bool: True if the container was processed successfully, False otherwise.
+        bool: True if at least one container was claimed, False otherwise.
     """
-    image_name = get_unscanned_container()
-    if not image_name:
-        return False
+    claimed_any = False
+    while image_names := await asyncio.to_thread(get_unscanned_containers):
+        claimed_any = True
+
+        for image_name in image_names:
+            if await asyncio.to_thread(pull_container, image_name):
+                await pulled.put(image_name)
+            else:
+                # The download_status update is already queued by the pull_container function
+                logging.info(f"Skipped processing for {image_name} due to download issues")
+
+    await pulled.put(None)
+    return claimed_any
+
+async def scan_stage(pulled):
+    """
+    Scans and then deletes each pulled image, queuing the upload of its scan result,
+    or marking it as 'scan_failed' if the scan produced no result.
+
+    Args:
+        pulled (asyncio.Queue): The names of pulled images, terminated by None.
+
+    Returns:
+        None
+    """
+    while (image_name := await pulled.get()) is not None:
+        scan_result = await asyncio.to_thread(scan_container, image_name)
+        await asyncio.to_thread(delete_container, image_name)
 
-    if pull_container(image_name):
-        scan_result = scan_container(image_name)
-        delete_container(image_name)
-        
         if scan_result:
-            parse_and_upload_scan_result(scan_result, image_name)
+            await asyncio.to_thread(submit_db_write, parse_and_upload_scan_result, scan_result, image_name)
         else:
-            update_download_status(image_name, 'scan_failed')
+            await asyncio.to_thread(submit_db_write, update_download_status, image_name, 'scan_failed')
             logging.error(f"Failed to scan {image_name}")
+
+async def run_pipeline():
+    """
+    Runs the pull and scan stages concurrently, connected by a bounded queue,
+    so that one image can be pulled while the previous one is scanned.
+
+    Returns:
+        bool: True if at least one container was claimed, False otherwise.
+    """
+    pulled = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    claimed_any, _ = await asyncio.gather(
+        pull_stage(pulled),
+        scan_stage(pulled)
+    )
+    return claimed_any
+
+def submit_db_write(operation, *args):
+    """
+    Queues a database write for the writer thread of the running process_container call,
+    or runs it directly when called outside of one.
+
+    Blocks while the queue is full, so scan results cannot pile up faster than they are uploaded.
+
+    Args:
+        operation (callable): The function performing the write, e.g. update_download_status.
+        *args: The arguments to call it with.
+
+    Returns:
+        None
+    """
+    if _DB_WRITES is None:
+        retry_on_disconnect(operation, *args)
     else:
-        # The download_status is already updated in pull_container function
-        logging.info(f"Skipped processing for {image_name} due to download issues")
-    
-    return True
+        _DB_WRITES.put((operation, args))
+
+def db_writer(write_queue):
+    """
+    Runs queued database writes on this thread's persistent connection until a None sentinel is received.
+    A write that fails because the connection was lost is retried once on a new connection.
+
+    Args:
+        write_queue (queue.Queue): (operation, args) tuples, terminated by None.
+
+    Returns:
+        None
+    """
+    while (item := write_queue.get()) is not None:
+        operation, args = item
+        try:
+            retry_on_disconnect(operation, *args)
+        except Exception as e:
+            # Keep the writer alive so later writes and the final join are not lost
+            logging.error(f"Error running {operation.__name__}: {e}")
+        finally:
+            write_queue.task_done()
+    write_queue.task_done()
+
+def process_container():
+    """
+    Process containers until no unscanned containers remain, using a two-stage pipeline
+    that hands its database writes to a background writer thread:
+    1. Pull: claim a batch of unscanned containers and pull each image.
+       If there are download issues, queue the download status update, log an info message and skip the container.
+    2. Scan: scan the container image, then delete it.
+       If the scan result is available, queue its upload.
+       Otherwise, queue updating the download status of the container to 'scan_failed' and log an error message.
+    3. Write: the writer thread uploads the queued results and status updates while the next images are pulled and scanned.
+    All queued writes are committed before returning.
+    Returns:
+        bool: True if at least one container was processed, False if no unscanned container was found.
+    """
+    global _DB_WRITES
+    _DB_WRITES = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    writer = threading.Thread(target=db_writer, args=(_DB_WRITES,), daemon=True)
+    writer.start()
+    try:
+        return asyncio.run(run_pipeline())
+    finally:
+        _DB_WRITES.put(None)
+        _DB_WRITES.join()
+        _DB_WRITES = None
+
+def decode_mount_path(path):
+    """
+    Decodes the octal escapes /proc/mounts uses for spaces, tabs, newlines and backslashes in paths.
+
+    Args:
+        path (str): The path as written in /proc/mounts, e.g. '/mnt/docker\\040root'.
+
+    Returns:
+        str: The decoded path.
+    """
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), path)
+
+def check_docker_root():
+    """
+    Warns if the Docker data root is not on a tmpfs mount.
+
+    Every image is written to the data root by the pull and read back straight away by grype,
+    so keeping it in memory avoids a disk write and read per layer.
+
+    The check reads this process's /proc/mounts, so it is skipped whenever that may not show
+    the daemon's mounts: a remote daemon, or a scanner running in its own container.
+
+    Returns:
+        None
+    """
+    client = docker.from_env()
+    try:
+        info = client.info()
+    finally:
+        client.close()
+    docker_root = info['DockerRootDir']
+
+    docker_host = os.environ.get('DOCKER_HOST', '')
+    if docker_host and not docker_host.startswith('unix://'):
+        logging.info(f"Docker daemon at {docker_host} is remote, skipping the tmpfs check for {docker_root}")
+        return
+    if info.get('Name') != socket.gethostname() or os.path.exists('/.dockerenv') or not os.path.isdir(docker_root):
+        logging.info(f"Docker daemon does not share this host's mounts, skipping the tmpfs check for {docker_root}")
+        return
+
+    try:
+        with open('/proc/mounts') as mounts:
+            mount_points = {decode_mount_path(fields[1]): fields[2] for fields in (line.split() for line in mounts)}
+    except OSError:
+        logging.info(f"Cannot read /proc/mounts, skipping the tmpfs check for {docker_root}")
+        return
+
+    # The data root lives on the longest mount point that contains it
+    mount_point = max(
+        (path for path in mount_points if os.path.join(docker_root, '').startswith(os.path.join(path, ''))),
+        key=len
+    )
+    if mount_points[mount_point] != 'tmpfs':
+        logging.warning(f"Docker root dir {docker_root} is on {mount_points[mount_point]}, not tmpfs; "
+                        "pulled layers will be written to and re-read from disk")
+
+def has_unique_index(cur, table, columns):
+    """
+    Checks whether a table already has a valid, non-partial unique index on exactly the given columns,
+    whether declared as a constraint or as a plain index and under any name.
+    Only key columns are compared; INCLUDE columns follow the first indnkeyatts entries of indkey.
+
+    Args:
+        cur (psycopg2.extensions.cursor): The cursor to query the catalog with.
+        table (str): The name of the table.
+        columns (tuple of str): The indexed column names.
+
+    Returns:
+        bool: True if such an index exists, False otherwise.
+    """
+    cur.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_index i
+            WHERE i.indrelid = %s::regclass
+              AND i.indisunique
+              AND i.indisvalid
+              AND i.indpred IS NULL
+              AND ARRAY(
+                  SELECT a.attname::text FROM pg_attribute a
+                  WHERE a.attrelid = i.indrelid
+                    AND a.attnum = ANY((i.indkey::int2[])[0:i.indnkeyatts - 1])
+                  ORDER BY a.attname
+              ) = %s::text[]
+        )
+    """, (table, sorted(columns)))
+    return cur.fetchone()[0]
+
+def drop_invalid_index(cur, index_name):
+    """
+    Drops an index left INVALID by an interrupted or failed CREATE INDEX CONCURRENTLY,
+    which CREATE INDEX ... IF NOT EXISTS would otherwise silently keep.
+
+    Args:
+        cur (psycopg2.extensions.cursor): The cursor to run the statements with, in autocommit mode.
+        index_name (str): The name of the index.
+
+    Returns:
+        None
+    """
+    cur.execute("""
+        SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)
+    """, (index_name,))
+    row = cur.fetchone()
+    if row and row[0]:
+        logging.warning(f"Dropping invalid index {index_name} left by an earlier failed build")
+        cur.execute(f"DROP INDEX CONCURRENTLY {index_name}")
+
+def ensure_indexes():
+    """
+    Creates the indexes the scanner's hot-path queries rely on, if they do not exist yet.
+
+    The partial index on pending images lets each claim read the most pulled images
+    straight from the index instead of sorting the whole table. The unique indexes back
+    the ON CONFLICT clauses; they are skipped when an equivalent one already exists,
+    so an existing constraint is not duplicated.
+
+    Returns:
+        None
+    """
+    conn = psycopg2.connect(**DB_PARAMS)
+    try:
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            drop_invalid_index(cur, 'images_pending_by_pulls')
+            cur.execute("""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS images_pending_by_pulls
+                ON images (pull_count DESC NULLS LAST)
+                WHERE is_scanned = FALSE AND download_status = 'pending'
+            """)
+
+            for index_name, table, columns in UNIQUE_INDEXES:
+                if not has_unique_index(cur, table, columns):
+                    logging.info(f"Creating unique index {index_name} on {table} ({', '.join(columns)})")
+                    drop_invalid_index(cur, index_name)
+                    cur.execute(f"""
+                        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {index_name}
+                        ON {table} ({', '.join(columns)})
+                    """)
+    finally:
+        conn.close()
+
+def update_grype_db(check=True):
+    """
+    Updates the grype vulnerability database.
+
+    Args:
+        check (bool): Whether to raise if the update fails, rather than log the error
+            and keep scanning with the current database.
+
+    Raises:
+        subprocess.CalledProcessError: If the update fails and check is True.
+
+    Returns:
+        None
+    """
+    try:
+        subprocess.run(['grype', 'db', 'update'], check=True, env=GRYPE_ENV)
+    except subprocess.CalledProcessError as e:
+        if check:
+            raise
+        logging.error(f"Error updating the grype database, retrying in {GRYPE_DB_UPDATE_INTERVAL} seconds: {e}")
+
+def update_grype_db_between_scans(scan_gate, active_scans):
+    """
+    Updates the grype database while the workers are running.
+
+    grype replaces its database directory in place, so a scan starting mid-update would fail
+    and be recorded as 'scan_failed' for good. New scans are held back and running ones are
+    allowed to finish first; a failed update is logged and scanning resumes.
+
+    Args:
+        scan_gate (multiprocessing.Event): Set while grype scans may start.
+        active_scans (multiprocessing.Value): Number of grype scans running across workers.
+
+    Returns:
+        None
+    """
+    with active_scans.get_lock():
+        scan_gate.clear()
+    try:
+        logging.info("Pausing scans to update the grype database...")
+        while True:
+            with active_scans.get_lock():
+                if active_scans.value == 0:
+                    break
+            time.sleep(1)
+        update_grype_db(check=False)
+    finally:
+        scan_gate.set()
+
+def reset_in_progress_images():
+    """
+    Returns images left 'in_progress' by an earlier run to 'pending', so they are claimed again.
+
+    Images stay 'in_progress' when the scanner or the database server stops mid-scan.
+    Any other scanner's claims would be reset too, so this only runs when RESET_IN_PROGRESS is set.
+
+    Returns:
+        None
+    """
+    conn = psycopg2.connect(**DB_PARAMS)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE images
+                    SET download_status = 'pending'
+                    WHERE download_status = 'in_progress'
+                      AND is_scanned = FALSE
+                """)
+                logging.info(f"Reset {cur.rowcount} images left in progress by a previous run")
+    finally:
+        conn.close()
 
 def main():
     """
     This function is the entry point of the DockerDetective application.
-    It updates the grype database and processes containers using a process pool executor.
+    It updates the grype database, processes containers using a process pool executor,
+    and keeps the grype database up to date while the workers run.
     Parameters:
     None
     Returns:
     None
     """
     # run command: grype db update before getting started
-    subprocess.run(['grype', 'db', 'update'], check=True)
+    update_grype_db()
+    last_db_update = time.monotonic()
+
+    check_docker_root()
+    ensure_indexes()
+    if RESET_IN_PROGRESS:
+        reset_in_progress_images()
     
-    with concurrent.futures.ProcessPoolExecutor(max_workers=NUM_PROCESSES) as executor:
-        while True:
-            futures = [executor.submit(process_container) for _ in range(NUM_PROCESSES)]
-            if not any(future.result() for future in concurrent.futures.as_completed(futures)):
-                break
+    pull_semaphore = multiprocessing.Semaphore(MAX_CONCURRENT_PULLS)
+    scan_gate = multiprocessing.Event()
+    scan_gate.set()
+    active_scans = multiprocessing.Value('i', 0)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=NUM_PROCESSES, initializer=init_worker,
+                                                initargs=(pull_semaphore, scan_gate, active_scans)) as executor:
+        # Resubmit as soon as any worker finishes, instead of waiting for a whole wave,
+        # and stop once every in-flight worker has found nothing left to scan
+        futures = {executor.submit(process_container) for _ in range(NUM_PROCESSES)}
+        while futures:
+            # Wake up when the database is due for an update, since workers can run for days
+            timeout = max(0, GRYPE_DB_UPDATE_INTERVAL - (time.monotonic() - last_db_update))
+            done, futures = concurrent.futures.wait(futures, timeout=timeout,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            if time.monotonic() - last_db_update >= GRYPE_DB_UPDATE_INTERVAL:
+                update_grype_db_between_scans(scan_gate, active_scans)
+                last_db_update = time.monotonic()
+
+            for future in done:
+                if future.result():
+                    futures.add(executor.submit(process_container))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file